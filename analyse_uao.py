@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import csv
+import csv, collections
 import os, time, getopt, sys, calendar, re
-import glob
-import operator, argparse
-from functools import reduce
+import glob, gzip, atexit
+import operator, argparse, logging
+from functools import lru_cache, wraps
 
 parser = argparse.ArgumentParser('UAO log analysis')
 parser.add_argument('day', type=str, help='UTC date YYYYMMDD format')
@@ -15,10 +15,42 @@ parser.add_argument('--outdir', type=str, default='.', help='output directory fo
 parser.add_argument('--verbose', action='store_true', default=False, help='verbose output')
 args = parser.parse_args()
 
+logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                    stream=sys.stderr, format='%(message)s')
+logger = logging.getLogger(__name__)
+
+# Regular expressions used to parse log lines
+_FLOAT = r'[-+]?(?:\d*\.\d+|\d+)'
+_FLOAT_RE = re.compile(_FLOAT)
+_WFS_RE = re.compile(r'wfsSpec = (\w+)WFS')
+_MAG_RE = re.compile(r'expectedStarMagnitude = (%s)' % _FLOAT)
+_REFX_RE = re.compile(r'roCoordX = (%s)' % _FLOAT)
+_REFY_RE = re.compile(r'roCoordY = (%s)' % _FLOAT)
+_MODE_RE = re.compile(r'mode = (\w+)')
+_ACT_RE = re.compile(r'Failing actuator detected N. (\d+)(.*)')
+_DETAIL_RE = re.compile(r'\>  \. (.*)')
+_REQ1_RE = re.compile(r'Request: (.*?)\((.*)\)')
+_REQ2_RE = re.compile(r'Request: (.*)')
+_REQ3_RE = re.compile(r'has received command \d+ \((.*)\)') # FLAO command
+
+@lru_cache(maxsize=None)
+def _parse_seconds(timestamp):
+    '''Converts a "YYYY-MM-DD HH:MM:SS" string into a unix timestamp'''
+    y = int(timestamp[0:4])
+    mo = int(timestamp[5:7])
+    d = int(timestamp[8:10])
+    h = int(timestamp[11:13])
+    mi = int(timestamp[14:16])
+    s = int(timestamp[17:19])
+    return calendar.timegm((y, mo, d, h, mi, s, 0, 0, 0))
+
+def log_timestamp_from_fields(fields):
+    '''Returns the timestamp of a log line already split on "|"'''
+    timestamp, microsec = fields[3].split('.', 1)
+    return _parse_seconds(timestamp) + float(microsec)/1e6
+
 def log_timestamp(line):
-    fields = line.split('|')
-    timestamp, microsec = fields[3].split('.')
-    return calendar.timegm(time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')) + float(microsec)/1e6
+    return log_timestamp_from_fields(line.split('|', 5))
 
 def julianDayFromUnix(timestamp):
     return (timestamp / 86400.0) + 2440587.5;
@@ -33,57 +65,83 @@ def hourStr(t):
     return time.strftime('%H:%M:%S', time.gmtime(t))
 
 
+# Compiled grep filters, shared by all logfile() calls
+_GREP_CACHE = {}
+
 def logfile(name, grep=None):
-    ''''
-    Returns a file-like object to read log files
+    '''
+    Returns an iterator over the lines of the log files,
+    optionally keeping only those lines containing the "grep" string
     '''
     y = args.day[0:4]
     m = args.day[4:6]
     d = args.day[6:8]
     glob_pattern = f'{args.logdir}/{y}/{m}/{d}/{name}.{args.side}.{args.day}[0-9][0-9][0-9][0-9].log*'
-    logfiles = ' '.join(sorted(glob.glob(glob_pattern)))
+    logfiles = sorted(glob.glob(glob_pattern))
 
     if not logfiles: raise Exception(f'Cannot find log file(s) matching: {glob_pattern}')
 
-    if args.verbose: print(f'Reading grep: "{grep}" glob: {logfiles}', file=sys.stderr)
+    logger.debug('Reading grep: "%s" glob: %s', grep, ' '.join(logfiles))
 
-    # zcat/zgrep allow compressed or uncompressed files
-    if grep is None:
-        return os.popen(f'zcat {logfiles}')
-    else:
-        return os.popen(f'zgrep "{grep}" {logfiles}')
+    if grep is not None:
+        pattern = _GREP_CACHE.setdefault(grep, re.compile(re.escape(grep)))
+
+    def _iter():
+        for path in logfiles:
+            # Allow compressed or uncompressed files
+            opener = gzip.open if path.endswith('.gz') else open
+            try:
+                with opener(path, 'rt', encoding='utf-8', errors='replace') as fh:
+                    if grep is None:
+                        yield from fh
+                    else:
+                        for line in fh:
+                            if pattern.search(line):
+                                yield line
+            except (EOFError, OSError) as e:
+                # Truncated or corrupt file: keep what was read so far
+                logger.warning('Error reading %s: %s', path, e)
+
+    return _iter()
 
-def search(name, string=None, mindiff=1, getDict=False):
+def search(name, string=None, mindiff=1, getDict=False, presorted=True):
+    '''
+    Returns the log lines containing "string", skipping lines less than
+    mindiff seconds after the previous one. Log files are read
+    in filename order, which for log files is also time order:
+    set presorted=False if that is not the case.
+    '''
 
     found = logfile(name, grep=string)
     prev=0
-    found2={}
-    p = re.compile('\>  \. (.*)')
+    found2=[]
     for f in found:
-        now = log_timestamp(f)
+        fields = f.split('|', 5)
+        now = log_timestamp_from_fields(fields)
         if now-prev>= mindiff:
-            if not now in found2:
-                found2[now] = f.strip()
+            # Lines with the same timestamp as the previous one
+            # are continuations of the same log message
+            if not found2 or found2[-1][0] != now:
+                found2.append((now, [f.strip()]))
             else:
                 try:
-                    fields = f.split('|')
-                    m = p.search(fields[4])
+                    m = _DETAIL_RE.search(fields[4])
                     if m:
-                        found2[now] += m.group(1)
+                        found2[-1][1].append(m.group(1))
                 except IndexError as e:
-                    print('Malformed line: '+f)
+                    logger.warning('Malformed line: %s', f.strip())
         else:
             if args.verbose:
-                print('Rejected '+f.strip(), file=sys.stderr)
+                logger.debug('Rejected %s', f.strip())
         prev=now
 
+    if not presorted:
+        found2.sort(key=operator.itemgetter(0))
+
     if getDict:
-        return found2
+        return {t: ''.join(parts) for t, parts in found2}
 
-    found3 = []
-    for k in sorted(found2.keys()):
-        found3.append(found2[k])
-    return found3
+    return [''.join(parts) for t, parts in found2]
 
 
 def myRound(x, ndigits=0):
@@ -114,8 +172,11 @@ class SkipFrameEvent(Event):
     @staticmethod
     def fromLogLine(line):
         t = log_timestamp(line)
-        line = line.replace('->', '--') # Avoid extra ">"
-        log, msg = line.split('>')
+        # Message starts after the first ">" that is not part of a "->"
+        pos = line.find('>')
+        while pos > 0 and line[pos-1] == '-':
+            pos = line.find('>', pos+1)
+        msg = line[pos+1:].replace('->', '--')
         return SkipFrameEvent( t, msg)
 
 
@@ -127,10 +188,9 @@ class FailedActuatorEvent(Event):
     @staticmethod
     def fromLogLine(line):
         t = log_timestamp(line)
-        pattern = 'Failing actuator detected N. (\d+)(.*)'
-        found = re.findall( pattern, line)
-        if len(found) > 0:
-            actno, reason = found[0]
+        m = _ACT_RE.search(line)
+        if m:
+            actno, reason = m.groups()
             log, msg = line.split('>')
         return FailedActuatorEvent( t, 'Act: %s - %s' % (actno, msg), int(actno))
 
@@ -161,12 +221,19 @@ class ArbCmd:
         self.end_time = end_time
         self.success = success
         self.errstr = errstr
-        self.floatPattern ='[-+]?\d*\.\d+|d+'
-        self.wfsPattern ='wfsSpec = (\w+)WFS'
-        self.magPattern ='expectedStarMagnitude = (%s)' % self.floatPattern
-        self.refXPattern = 'roCoordX = (%s)' % self.floatPattern
-        self.refYPattern = 'roCoordY = (%s)' % self.floatPattern
-        self.modePattern = 'mode = (\w+)'
+        self._parsed = False
+
+    @property
+    def errstr(self):
+        return ''.join(self._errparts)
+
+    @errstr.setter
+    def errstr(self, errstr):
+        self._errparts = [errstr]
+
+    def append_errstr(self, errstr):
+        '''Adds to the error string, without rebuilding it each time'''
+        self._errparts.append(errstr)
  
     def report(self):
         time_str = timeStr(self.start_time)
@@ -202,11 +269,31 @@ class ArbCmd:
         if not self.name == 'PresetAO':
             return False
 
-        # Make sure mag, refX and refY are there
-        _ = self.details()
+        try:
+            self._parse_preset_args()
+        except (AttributeError, ValueError):
+            return False
 
         return self.refX != 0 or self.refY != 0 
 
+    def _parse_preset_args(self):
+        '''Sets wfs, mag, refX, refY and mode from the PresetAO arguments'''
+        if self._parsed:
+            return
+
+        wfs = _WFS_RE.search(self.args).group(1)
+        mag = float(_MAG_RE.search(self.args).group(1))
+        refX = float(_REFX_RE.search(self.args).group(1))
+        refY = float(_REFY_RE.search(self.args).group(1))
+        mode = _MODE_RE.search(self.args).group(1)
+
+        self.wfs = wfs
+        self.mag = mag
+        self.refX = refX
+        self.refY = refY
+        self.mode = mode
+        self._parsed = True
+
     def details2(self):
 
         details2=[]
@@ -217,7 +304,7 @@ class ArbCmd:
             if self.name == 'ExposureSequence':
                 details2.append('Time exposing: %.1fs' % self.time_exposing())
         except Exception as e:
-            print(e)
+            logger.warning('%s: %s', self.name, e)
 
         return details2
 
@@ -227,17 +314,14 @@ class ArbCmd:
         details=[]
         try:
             if self.name == 'OffsetSequence' or self.name == 'OffsetXY':
-                coords = map( float, re.findall( self.floatPattern, self.args))
-                if len(coords) ==2:
-                    details.append('X=%.2f, Y=%.2f mm' % (coords[0], coords[1]))
+                coords = _FLOAT_RE.findall(self.args)
+                if len(coords) == 2:
+                    x, y = float(coords[0]), float(coords[1])
+                    details.append('X=%.2f, Y=%.2f mm' % (x, y))
 
             if self.name == 'PresetAO':
-                wfs = re.findall( self.wfsPattern, self.args)[0]
-                mag = float(re.findall( self.magPattern, self.args)[0])
-                refX = float(re.findall( self.refXPattern, self.args)[0])
-                refY = float(re.findall( self.refYPattern, self.args)[0])
-                mode = re.findall(self.modePattern, self.args)[0]
-                details.append('%s, star mag= %.1f, posXY= %.1f, %.1f mm, mode = %s' % (wfs, mag, myRound(refX, 1), myRound(refY, 1), mode))
+                self._parse_preset_args()
+                details.append('%s, star mag= %.1f, posXY= %.1f, %.1f mm, mode = %s' % (self.wfs, self.mag, myRound(self.refX, 1), myRound(self.refY, 1), self.mode))
                 if hasattr(self, 'intervention'):
                     if self.intervention == True:
                         interventionDesc = 'Intervention mode'
@@ -246,11 +330,6 @@ class ArbCmd:
                 else:
                     interventionDesc = 'Intervention/automatic mode unknown'
               
-                self.wfs = wfs
-                self.mag = mag
-                self.refX = refX
-                self.refY = refY
-                self.mode = mode
                 details.append(interventionDesc) 
 
             if self.name == 'CompleteObs':
@@ -272,7 +351,7 @@ class ArbCmd:
                 if hasattr(self, 'hoSpeed'):
                     details.append('Loop speed: %d Hz' % self.hoSpeed)
         except Exception as e:
-            print(e)
+            logger.warning('%s: %s', self.name, e)
 
         return details
 
@@ -287,10 +366,6 @@ def get_AOARB_cmds():
     startCmdFlao = 'FSM (status'
     startCmdUao = 'Request:'
 
-    p1 = re.compile('Request: (.*?)\((.*)\)')
-    p2 = re.compile('Request: (.*)')
-    p3 = re.compile('has received command \d+ \((.*)\)') # FLAO command
-
     endCmdFlao = ' successfully completed'
     endCmdUao  = 'Status after command:'
 
@@ -317,28 +392,24 @@ def get_AOARB_cmds():
                 curCmd = None
 
             t = log_timestamp(line)
-            m1 = p1.search(line)
-            m2 = p2.search(line)
-            m3 = p3.search(line)
-            args = ''
-            try:
-                if m1:
-                    name = m1.group(1)
-                    args = m1.group(2)
-                elif m2:
-                    name = m2.group(1)
-                elif m3:
-                    name = m3.group(1)
+            cmdArgs = ''
+            if startCmdUao in line:
+                # UAO request, with or without arguments
+                m = _REQ1_RE.search(line)
+                if m:
+                    name, cmdArgs = m.group(1), m.group(2)
                 else:
-                    print('Malformed request: '+line)
+                    name = _REQ2_RE.search(line).group(1)
+            else:
+                m = _REQ3_RE.search(line)
+                if not m:
+                    logger.warning('Malformed request: %s', line)
                     continue
-            except IndexError as e:
-                print('Malformed request: '+line)
-                continue
+                name = m.group(1)
  
             default_success = None
 
-            curCmd = ArbCmd(name=name, args=args, start_time=t, end_time=None, success=default_success, errstr='')
+            curCmd = ArbCmd(name=name, args=cmdArgs, start_time=t, end_time=None, success=default_success, errstr='')
             if name == 'AcquireRefAO':
                 lastAcquireRef = curCmd
 
@@ -386,8 +457,7 @@ def get_AOARB_cmds():
             curCmd.hoSpeed = int(line[pos+len(hoSpeedStr):].split()[0])
 
       except Exception as e:
-        if args.verbose:
-            print(e, file=sys.stderr)
+        logger.debug(e)
  
     # Store last command
     if curCmd is not None:
@@ -428,27 +498,48 @@ class ExposureSequence(ArbCmd):
 
     
 
+def _cached(method):
+    '''Caches the result of a method without arguments in self._cache'''
+    @wraps(method)
+    def wrapper(self):
+        try:
+            return self._cache[method.__name__]
+        except KeyError:
+            value = self._cache[method.__name__] = method(self)
+            return value
+    return wrapper
+
+
 class CompleteObs(ArbCmd):
+    '''
+    A complete observation. Timing methods are cached, and must
+    only be called after all commands have been added.
+    '''
 
     def __init__(self, *args, **kwargs):
         ArbCmd.__init__(self, *args, **kwargs)
         self.cmds = []
+        self._cache = {}
 
+    @_cached
     def total_time(self):
         '''Total observation time from start of PresetAO to end of StopAO'''
         if self.end_time is None or self.start_time is None:
             return 0
         return self.end_time - self.start_time
 
+    @_cached
     def total_open_time(self):
         '''Total time available from instrument'''
         return self.total_time() - self.setup_duration() - self.offsets_overhead()
 
+    @_cached
     def setup_duration(self):
         '''Total setup time from start of PresetAO to end of StartAO'''
         startao = list(filter(lambda x: x.name in ['StartAO', 'Start AO'], self.cmds))[0]
         return startao.end_time - self.start_time
 
+    @_cached
     def ao_setup_overhead(self):
         '''Total AO time from start of PresetAO to end of StartAO'''
         ao_time = 0
@@ -472,10 +563,12 @@ class CompleteObs(ArbCmd):
                 return ao_time
         return 0
 
+    @_cached
     def telescope_overhead(self):
         '''Telescope overhead during setup time'''
         return self.setup_duration() - self.ao_setup_overhead()
 
+    @_cached
     def offsets_overhead(self):
         '''Time spent executing offsets'''
         offsets_time = 0
@@ -487,6 +580,7 @@ class CompleteObs(ArbCmd):
                 offsets_time += resume_time - pause_time
         return offsets_time
 
+    @_cached
     def total_ao_overhead(self):
         '''Time spent executing AO commands'''
         return self.ao_setup_overhead() + self.offsets_overhead()
@@ -555,7 +649,7 @@ def detectAcquires(cmds):
 
             if cmd.name == 'CheckFlux':
                 acquireCmd.success = acquireCmd.success and cmd.success
-                acquireCmd.errstr += cmd.errstr
+                acquireCmd.append_errstr(cmd.errstr)
                 acquireCmd.end_time = cmd.end_time
                 if hasattr(cmd, 'estimatedMag'):
                     acquireCmd.estimatedMag = cmd.estimatedMag
@@ -568,12 +662,12 @@ def detectAcquires(cmds):
                ['CenterPupils', 'CenterStar', 'CloseLoop', 'OptimizeGain',
                 'ReCloseLoop', 'getLastImage', 'ApplyOpticalGain']:
                 acquireCmd.success = acquireCmd.success and cmd.success
-                acquireCmd.errstr += cmd.errstr
+                acquireCmd.append_errstr(cmd.errstr)
                 acquireCmd.end_time = cmd.end_time
  
             elif cmd.name == 'Done':
                 acquireCmd.success = acquireCmd.success and cmd.success
-                acquireCmd.errstr += cmd.errstr
+                acquireCmd.append_errstr(cmd.errstr)
                 acquireCmd.end_time = cmd.end_time
                 acquireDone = True
 
@@ -584,7 +678,7 @@ def detectAcquires(cmds):
             else:
                 if not acquireDone:
                     acquireCmd.success = False
-                    acquireCmd.errstr += ' Command not completed'
+                    acquireCmd.append_errstr(' Command not completed')
                     newCmds.append( acquireCmd)
                     inAcquire = False
 
@@ -593,156 +687,165 @@ def detectAcquires(cmds):
     return newCmds
        
 
-def detectOffsets(cmds):
-    '''
-    Detect Pause-Offset-Resume sequences and build a meta 'Offset' command
-    for each of them.
-    '''
+def _pause_offset_resume(cmds):
+    t0 = cmds[0].start_time
+    t1 = cmds[2].end_time
+    success = all(x.success is True for x in cmds[0:3])
+    errstr = ' '.join(x.errstr for x in cmds[0:3])
+    args = cmds[1].args
 
-    if len(cmds)<3:
-        return cmds
+    return OffsetSequence(cmds[0], cmds[2], args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
 
-    newCmds = []
-    for n in range(len(cmds)-2):
 
-        if cmds[n].name == 'Pause' and \
-           cmds[n+1].name == 'OffsetXY' and \
-           cmds[n+2].name == 'Resume':
+def _pause_offset(cmds):
+    # Last command is not a Resume
+    t0 = cmds[0].start_time
+    t1 = cmds[1].end_time
+    success = all(x.success is True for x in cmds[0:2])
+    errstr = ' '.join(x.errstr for x in cmds[0:2])
+    args = cmds[1].args
 
-           t0 = cmds[n+0].start_time
-           t1 = cmds[n+2].end_time
-           success = reduce(operator.and_, [x.success for x in cmds[n:n+3]])
-           errstr = ' '.join([x.errstr for x in cmds[n:n+3]])
-           args = cmds[n+1].args
+    if success:
+        success = False
+        errstr = 'Resume was not sent'
 
-           cmd = OffsetSequence(cmds[n], cmds[n+2], args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
-           newCmds.append(cmd) 
+    return OffsetSequence(cmds[0], None, args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
 
-        elif cmds[n].name == 'Pause' and \
-           cmds[n+1].name == 'OffsetXY':
-           # Last command is not a Resume
 
-           t0 = cmds[n+0].start_time
-           t1 = cmds[n+1].end_time
-           success = reduce(operator.and_, [x.success is True for x in cmds[n:n+2]])
-           errstr = ' '.join([x.errstr for x in cmds[n:n+2]])
-           args = cmds[n+1].args
+def _pause_resume(cmds):
+    t0 = cmds[0].start_time
+    t1 = cmds[1].end_time
+    success = cmds[0].success and cmds[1].success
+    errstr = cmds[0].errstr + ' ' + cmds[1].errstr
 
-           if success:
-               success = False
-               errstr = 'Resume was not sent'
+    return OffsetSequence(cmds[0], cmds[1], args='', start_time=t0, end_time=t1, success=success, errstr=errstr)
 
-           cmd = OffsetSequence(cmds[n], None, args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
-           newCmds.append(cmd) 
 
-        elif cmds[n].name == 'Pause' and \
-             cmds[n+1].name == 'Resume':
+def _pause_only(cmds):
+    # Next command is not an OffsetXY nor a Resume
+    t0 = cmds[0].start_time
+    t1 = cmds[0].end_time
+    success = cmds[0].success
+    errstr = cmds[0].errstr
 
-           t0 = cmds[n].start_time
-           t1 = cmds[n+1].end_time
-           success = cmds[n].success and cmds[n+1].success
-           errstr = cmds[n].errstr + ' ' + cmds[n+1].errstr
-           args = ''
+    if success:
+        success = False
+        errstr = 'no OffsetXY or Resume'
 
-           cmd = OffsetSequence(cmds[n], cmds[n+1], args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
-           newCmds.append(cmd) 
+    return OffsetSequence(cmds[0], None, args='', start_time=t0, end_time=t1, success=success, errstr=errstr)
 
-        elif cmds[n].name == 'Pause':
-           # Next command is not an OffsetXY nor a Resume
 
-           t0 = cmds[n].start_time
-           t1 = cmds[n].end_time
-           success = cmds[n].success
-           errstr = cmds[n].errstr
-           args = ''
+def _resume_pause(cmds):
+    t0 = cmds[0].start_time
+    t1 = cmds[0].end_time
+    success = cmds[0].success and cmds[1].success
+    errstr = cmds[0].errstr + ' ' + cmds[1].errstr
 
-           if success:
-               success = False
-               errstr = 'no OffsetXY or Resume'
+    return ExposureSequence(cmds[0], cmds[1], args='', start_time=t0, end_time=t1, success=success, errstr=errstr)
 
-           cmd = OffsetSequence(cmds[n], None, args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
-           newCmds.append(cmd) 
 
-        elif cmds[n].name == 'Resume' and \
-             cmds[n+1].name == 'Pause':
+# Command name sequences recognized by detectOffsets(), longest first.
+_SEQUENCES = {
+    ('Pause', 'OffsetXY', 'Resume'): _pause_offset_resume,
+    ('Pause', 'OffsetXY'): _pause_offset,
+    ('Pause', 'Resume'): _pause_resume,
+    ('Pause',): _pause_only,
+    ('Resume', 'Pause'): _resume_pause,
+}
+
+
+def detectOffsets(cmds):
+    '''
+    Detect Pause-Offset-Resume sequences and build a meta 'Offset' command
+    for each of them. Resume-Pause sequences give a meta 'Exposure' command.
+    Each meta command is inserted just before its first command.
+    '''
 
-           t0 = cmds[n].start_time
-           t1 = cmds[n].end_time
-           success = cmds[n].success and cmds[n+1].success
-           errstr = cmds[n].errstr + ' ' + cmds[n+1].errstr
+    newCmds = []
+    for n, cmd in enumerate(cmds):
 
-           cmd = ExposureSequence(cmds[n], cmds[n+1], args=args, start_time=t0, end_time=t1, success=success, errstr=errstr)
-           newCmds.append(cmd) 
+        if cmd.name in ('Pause', 'Resume'):
+            names = tuple(x.name for x in cmds[n:n+3])
+            for key in (names, names[:2], names[:1]):
+                make_sequence = _SEQUENCES.get(key)
+                if make_sequence is not None:
+                    newCmds.append(make_sequence(cmds[n:n+3]))
+                    break
 
-        newCmds.append(cmds[n])
+        newCmds.append(cmd)
 
     return newCmds
 
 
-def cmdsByName(cmds, name):
-    return filter(lambda x: x.name == name, cmds)
+def cmdsByName(cmds):
+    '''Returns a dictionary of command lists, indexed by command name'''
+    byName = collections.defaultdict(list)
+    for cmd in cmds:
+        byName[cmd.name].append(cmd)
+    return byName
 
 
 def outputEvents(title, events, sort=True, complete_list=None):
 
+    out = []
     if sort:
-        ev = {}
-        sortedEvents = []
-        for e in events:
-            ev[e.t] = e
-        for k in sorted(ev.keys()):
-            sortedEvents.append(ev[k])
+        sortedEvents = sorted(events, key=operator.attrgetter('t'))
     else:
         sortedEvents = events
 
     if not args.html:
-        print()
-        print(title)
+        out.append('')
+        out.append(title)
 
-        print('Total: %d' % len(sortedEvents))
+        out.append('Total: %d' % len(sortedEvents))
         for e in sortedEvents:
-             print('%s %s %s' % (timeStr(e.t), e.name, e.details))
+             out.append('%s %s %s' % (timeStr(e.t), e.name, e.details))
 
     else:
-        print('<HR>')
-        print('<H2>%s</H2>' % title)
-        print('<p>Total: %d</p>' % len(sortedEvents))
+        out.append('<HR>')
+        out.append('<H2>%s</H2>' % title)
+        out.append('<p>Total: %d</p>' % len(sortedEvents))
         if len(sortedEvents)>0:
-            print('<table id="aotable">')
-            print(sortedEvents[0].htmlHeader())
+            out.append('<table id="aotable">')
+            out.append(sortedEvents[0].htmlHeader())
             for e in sortedEvents:
-                print(e.htmlRow())
+                row = e.htmlRow()
+                out.append(row)
                 if complete_list is not None:
-                    complete_list[timeStr(e.t)] = e.htmlRow()
-            print('</table>')
+                    complete_list[timeStr(e.t)] = row
+            out.append('</table>')
         else:
-            print('<p>')
+            out.append('<p>')
+
+    # Single write for the whole section
+    sys.stdout.write('\n'.join(out) + '\n')
 
 
 def output_cmd(title, found, complete_list=None):
 
     found = list(found)
+    out = []
     success = len([f for f in found if f.success])
     success_rate = 0
     if len(found)>0:
         success_rate = float(success) / len(found)
 
     if not args.html:
-        print()
-        print(title)
+        out.append('')
+        out.append(title)
 
-        print('Total: %d - Success rate: %d%%' % (len(found), int(success_rate*100)))
+        out.append('Total: %d - Success rate: %d%%' % (len(found), int(success_rate*100)))
         for f in found:
-             print(f.report())
+             out.append(f.report())
 
     else:
-        print('<HR>')
-        print('<H2>%s</H2>' % title)
-        print('<p>Total: %d - Success rate: %d%%</p>' % (len(found), int(success_rate*100)))
+        out.append('<HR>')
+        out.append('<H2>%s</H2>' % title)
+        out.append('<p>Total: %d - Success rate: %d%%</p>' % (len(found), int(success_rate*100)))
         if len(found)>0:
-            print('<p>')
-            print('<table id="aotable">')
-            print('<tr><th>Time</th><th>Command</th><th>Ex. time (s)</th><th style="width: 300px">Result</th><th>Details</th><th>More details</th></tr>')
+            out.append('<p>')
+            out.append('<table id="aotable">')
+            out.append('<tr><th>Time</th><th>Command</th><th>Ex. time (s)</th><th style="width: 300px">Result</th><th>Details</th><th>More details</th></tr>')
         for cmd in found:
             strtime = timeStr(cmd.start_time)
             if (cmd.end_time is not None) and (cmd.start_time is not None):
@@ -755,36 +858,93 @@ def output_cmd(title, found, complete_list=None):
                 errstr = cmd.errorString()
             row = '<tr><td>%s</td><td>%s</td><td>%s</td><td style="width: 300px">%s</td><td>%s</td><td>%s</td></tr>' % \
                   (strtime, cmd.name, elapsed, errstr, '<br>'.join(cmd.details()), '<br>'.join(cmd.details2()))
-            print(row)
+            out.append(row)
             if complete_list is not None:
                 complete_list[strtime] = row
 
         if len(found)>0:
-            print('</table>\n')
-            print('</p>')
+            out.append('</table>\n')
+            out.append('</p>')
 
+    sys.stdout.write('\n'.join(out) + '\n')
     return success_rate
 
 
+# CSV files are read once, updated in memory and written at exit
+_csv_cache = {}
+_csv_dirty = set()
+
+def _load_csv(csvfilename, hdr):
+    '''
+    Returns the list of data rows (header excluded) of a CSV file,
+    reading it from disk the first time only.
+    '''
+    if csvfilename not in _csv_cache:
+        if os.path.exists(csvfilename):
+            with open(csvfilename, 'r') as csvfile:
+                data = list(csv.reader(csvfile, delimiter=','))
+        else:
+            data = []
+
+        # Remove header if any
+        data = [row for row in data if row[0] != 'day']
+        _csv_cache[csvfilename] = (hdr, data)
+
+    return _csv_cache[csvfilename][1]
+
+
+def _store_csv(csvfilename, data):
+    _csv_cache[csvfilename] = (_csv_cache[csvfilename][0], data)
+    _csv_dirty.add(csvfilename)
+
+
+def _csv_lines(rows):
+    '''
+    Formats rows as CSV lines, the same way csv.writer does.
+    Returns None if any field would need quoting.
+    '''
+    lines = []
+    for row in rows:
+        row = [str(x) for x in row]
+        line = ','.join(row)
+        if line.count(',') != len(row)-1 or '"' in line or '\n' in line or '\r' in line:
+            return None
+        lines.append(line + '\r\n')
+    return lines
+
+
+def _flush_csv():
+    '''Writes back all modified CSV files'''
+    for csvfilename in sorted(_csv_dirty):
+        hdr, data = _csv_cache[csvfilename]
+        data.sort(key=lambda x: x[0])
+        lines = _csv_lines([hdr]+data)
+
+        # Save csv
+        with open(csvfilename, 'w', newline='') as csvfile:
+            if lines is not None:
+                csvfile.write(''.join(lines))
+            else:
+                csv.writer(csvfile, delimiter=',').writerows([hdr]+data)
+
+    _csv_dirty.clear()
+
+atexit.register(_flush_csv)
+
+
 def update_cmd_csv(cmds):
 
     csvfilename = os.path.join(args.outdir, 'cmd_%s.csv' % args.side)
-    # read csv
-    if os.path.exists(csvfilename):
-        with open(csvfilename, 'r') as csvfile:
-            data = list(csv.reader(csvfile, delimiter=','))
-    else:
-        data = []
 
     cmds = list(cmds)
     if len(cmds) < 1:
         return
 
-    # Remove anything matching this day/cmd (assumes all cmds are equal)
-    data = filter(lambda row: (row[0] != args.day) or (row[2] != cmds[0].name), data)
+    hdr = ('day', 'hour', 'command', 'elapsed')
+    data = _load_csv(csvfilename, hdr)
 
-    # Remove header if any
-    data = list(filter(lambda row: row[0] != 'day', data))
+    # Remove anything matching this day/cmd (assumes all cmds are equal)
+    data = [row for row in data if (row[0] != args.day) or (row[2] != cmds[0].name)]
 
     # Add our data
     for cmd in cmds:
@@ -799,57 +959,33 @@ def update_cmd_csv(cmds):
         row = (d, h, cmd.name, tottime)
         data.append(row)
 
-    data.sort(key=lambda x: x[0])
-
-    hdr = ('day', 'hour', 'command', 'elapsed')
-    data = [hdr]+data
-
-    # Save csv   
-    with open(csvfilename, 'w') as csvfile:
-        csv.writer(csvfile, delimiter=',').writerows(data)
+    _store_csv(csvfilename, data)
 
 
 def update_output_csv(cmds):
 
     csvfilename = os.path.join(args.outdir, 'data_%s.csv' % args.side)
 
-    # read csv
-    if os.path.exists(csvfilename):
-        with open(csvfilename, 'r') as csvfile:
-            data = list(csv.reader(csvfile, delimiter=','))
-    else:
-        data = []
+    hdr = ('day', 'hour', 'time', 'time_h', 'open', 'open_h', 'setup', 'aosetup', 'telsetup', 'offsets', 'wfs', 'mode', 'magnitude')
+    data = _load_csv(csvfilename, hdr)
 
     # Remove anything matching this day
-    data = filter(lambda row: row[0] != args.day, data)
-
-    # Remove header if any
-    data = list(filter(lambda row: row[0] != 'day', data))
+    data = [row for row in data if row[0] != args.day]
 
     # Add our data
     for cmd in cmds:
         d = dayStr(cmd.start_time)
         h = hourStr(cmd.start_time)
-        tottime = '%d' % cmd.total_time()
-        opentime = '%d' % cmd.total_open_time()
-        setuptime = '%d' % cmd.setup_duration()
-        aosetuptime = '%d' % cmd.ao_setup_overhead()
-        telsetuptime = '%d' % cmd.telescope_overhead()
-        offsetstime = '%d' % cmd.offsets_overhead()
-        tottime_h = str(float(tottime)/3600)
-        opentime_h = str(float(opentime)/3600)
-         
-        row = (d, h, tottime, tottime_h, opentime, opentime_h, setuptime, aosetuptime, telsetuptime, offsetstime, cmd.wfs, cmd.mode, cmd.mag)
-        data.append(row)
-
-    data.sort(key=lambda x: x[0])
+        tottime = int(cmd.total_time())
+        opentime = int(cmd.total_open_time())
 
-    hdr = ('day', 'hour', 'time', 'time_h', 'open', 'open_h', 'setup', 'aosetup', 'telsetup', 'offsets', 'wfs', 'mode', 'magnitude')
-    data = [hdr]+data
+        row = (d, h, f'{tottime}', f'{tottime/3600}', f'{opentime}', f'{opentime/3600}',
+               f'{int(cmd.setup_duration())}', f'{int(cmd.ao_setup_overhead())}',
+               f'{int(cmd.telescope_overhead())}', f'{int(cmd.offsets_overhead())}',
+               cmd.wfs, cmd.mode, f'{cmd.mag}')
+        data.append(row)
 
-    # Save csv   
-    with open(csvfilename, 'w') as csvfile:
-        csv.writer(csvfile, delimiter=',').writerows(data)
+    _store_csv(csvfilename, data)
 
 
 ##################
@@ -872,17 +1008,13 @@ AOARB_cmds = get_AOARB_cmds()
 AOARB_cmds = detectOffsets(AOARB_cmds)
 AOARB_cmds = detectAcquires(AOARB_cmds)
 AOARB_cmds = detectCompleteObs(AOARB_cmds)
+AOARB_byName = cmdsByName(AOARB_cmds)
 
-update_output_csv(cmdsByName(AOARB_cmds, 'CompleteObs'))
+update_output_csv(AOARB_byName.get('CompleteObs', []))
 
-update_cmd_csv(cmdsByName(AOARB_cmds, 'PresetAO'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'CenterStar'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'CenterPupils'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'CheckFlux'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'CloseLoop'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'OptimizeGain'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'ApplyOpticalGain'))
-update_cmd_csv(cmdsByName(AOARB_cmds, 'OffsetXY'))
+for name in ['PresetAO', 'CenterStar', 'CenterPupils', 'CheckFlux', 'CloseLoop',
+             'OptimizeGain', 'ApplyOpticalGain', 'OffsetXY']:
+    update_cmd_csv(AOARB_byName.get(name, []))
 
 table = {}
 success = {}
@@ -934,18 +1066,19 @@ for string, title in [
         ('MirrorRest',   'MirrorRest'),
         ]:
 
-    found = cmdsByName(AOARB_cmds, string)
+    found = AOARB_byName.get(string, [])
     output_cmd(title, found, complete_list=complete_list)
 
-print('<HR>')
-print('<H2>All logs in temporal order</H2>')
-print('<p>')
-print('<table id="aotable">')
-print('<tr><th>Time</th><th>Command</th><th>Ex. time (s)</th><th style="width: 300px">Result</th><th>Details</th><th>More details</th></tr>')
+out = ['<HR>',
+       '<H2>All logs in temporal order</H2>',
+       '<p>',
+       '<table id="aotable">',
+       '<tr><th>Time</th><th>Command</th><th>Ex. time (s)</th><th style="width: 300px">Result</th><th>Details</th><th>More details</th></tr>']
 for k in sorted(complete_list.keys()):
-    print(complete_list[k])
-print('</table>\n')
-print('</p>')
+    out.append(complete_list[k])
+out.append('</table>\n')
+out.append('</p>')
+sys.stdout.write('\n'.join(out) + '\n')
 
 
 #######